@@ -66,4 +66,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         raise credentials_exception
     
     user.session_id = None  # Regular users don't have session IDs
-    return user
\ No newline at end of file
+    return user
+
+def principal_key(user) -> str:
+    """Stable identity for per-user state (guests are keyed by session)"""
+    if user.role == "guest":
+        return f"guest:{getattr(user, 'session_id', None)}"
+    return f"user:{user.id}"
@@ -0,0 +1,226 @@
+import threading
+from contextlib import contextmanager
+import time
+import uuid
+import rag
+
+MAX_TURNS = 6                   # recent turns kept verbatim in the prompt
+MAX_PASSAGES = 10               # most recently retrieved documents kept in the prompt
+SESSION_TTL_SECONDS = 30 * 60   # idle conversations are evicted after this
+MAX_SESSIONS = 500              # hard cap, least recently used evicted first
+MAX_SESSIONS_PER_OWNER = 5      # a principal's oldest conversation goes first
+# Reused Ollama context is dropped above this many tokens, leaving the rest of
+# rag.NUM_CTX for new passages, the question and the answer
+CONTEXT_TOKEN_BUDGET = rag.NUM_CTX // 2
+
+_sessions = {}  # conversation_id -> Conversation
+_lock = threading.Lock()
+
+
+class Conversation:
+    """Chat history for one principal, plus the Ollama state to continue it"""
+
+    def __init__(self, owner: str):
+        self.id = str(uuid.uuid4())
+        self.owner = owner
+        self.passages = []      # retrieved docs already in the model's context
+        self.summary = ""       # summary of turns dropped from history
+        self.turns = []         # [(question, answer), ...]
+        self.context = None     # Ollama `context` tokens after the last turn
+        self.removed_ids = set()  # deleted docs that must not be used again
+        self.last_used = time.monotonic()
+        self.in_use = 0         # requests holding it via checkout(); never evicted then
+        self.lock = threading.Lock()
+
+
+def _evict_idle(now: float):
+    expired = [cid for cid, c in _sessions.items() if now - c.last_used > SESSION_TTL_SECONDS]
+    for cid in expired:
+        del _sessions[cid]
+    if expired:
+        print(f"🧹 Evicted {len(expired)} idle conversations")
+
+
+def _evict_lru(candidates: list, limit: int):
+    """Evict least recently used candidates until fewer than `limit` remain.
+
+    Conversations in use are skipped, so the cap may be briefly exceeded.
+    """
+    idle = sorted((c for c in candidates if not c.in_use), key=lambda c: c.last_used)
+    for conv in idle[:max(0, len(candidates) - limit + 1)]:
+        del _sessions[conv.id]
+
+
+def get_or_create(conversation_id: str, owner: str, pin: bool = False):
+    """Return the owner's conversation, or a new one if no id is given.
+
+    A new conversation first evicts the owner's own oldest ones, so one
+    principal cannot push everyone else out. Returns None when the id is
+    unknown, expired or owned by someone else.
+    """
+    now = time.monotonic()
+    with _lock:
+        _evict_idle(now)
+
+        if conversation_id:
+            conv = _sessions.get(conversation_id)
+            if conv is None or conv.owner != owner:
+                return None
+        else:
+            _evict_lru([c for c in _sessions.values() if c.owner == owner], MAX_SESSIONS_PER_OWNER)
+            _evict_lru(list(_sessions.values()), MAX_SESSIONS)
+            conv = Conversation(owner)
+            _sessions[conv.id] = conv
+            print(f"🆕 Conversation {conv.id[:8]} started for {owner}")
+
+        conv.last_used = now
+        if pin:
+            conv.in_use += 1
+        return conv
+
+
+@contextmanager
+def checkout(conversation_id: str, owner: str):
+    """get_or_create() for the length of a request; the conversation cannot be evicted meanwhile"""
+    conv = get_or_create(conversation_id, owner, pin=True)
+    try:
+        yield conv
+    finally:
+        if conv is not None:
+            with _lock:
+                conv.in_use -= 1
+
+
+def end(conversation_id: str, owner: str) -> bool:
+    with _lock:
+        conv = _sessions.get(conversation_id)
+        if conv is None or conv.owner != owner:
+            return False
+        del _sessions[conversation_id]
+        return True
+
+
+def drop_owner(owner: str):
+    """Forget every conversation of a principal (e.g. on guest logout)"""
+    with _lock:
+        for cid in [cid for cid, c in _sessions.items() if c.owner == owner]:
+            del _sessions[cid]
+
+
+def forget_document(doc_id: int):
+    """Drop a deleted document from every conversation.
+
+    A turn may be generating right now, so the removal is only queued here and
+    applied by the conversation itself under its own lock (see _apply_removals).
+    """
+    with _lock:
+        for conv in _sessions.values():
+            conv.removed_ids.add(doc_id)
+
+
+def _apply_removals(conv: Conversation, passages: list) -> list:
+    """Purge deleted documents; the Ollama context is discarded if it held one"""
+    kept = [p for p in passages if p.get('id') not in conv.removed_ids]
+    if len(kept) != len(passages):
+        conv.context = None
+    return kept
+
+
+def _merge_passages(known: list, retrieved: list) -> list:
+    """Known passages followed by retrieved ones, most recently retrieved last"""
+    retrieved_ids = {p.get('id') for p in retrieved}
+    return [p for p in known if p.get('id') not in retrieved_ids] + retrieved
+
+
+def _history_str(conv: Conversation) -> str:
+    parts = []
+    if conv.summary:
+        parts.append(f"Summary of the earlier conversation:\n{conv.summary}")
+    for question, answer in conv.turns:
+        parts.append(f"Question: {question}\nAnswer: {answer}")
+    return "\n\n".join(parts)
+
+
+def _summarize_overflow(conv: Conversation):
+    """Fold the oldest turns into the running summary.
+
+    On failure the history is left as is and folding is retried next turn.
+    """
+    keep = MAX_TURNS // 2
+    overflow = conv.turns[:-keep]
+    if not overflow:
+        # Too few turns to fold, a fresh prompt is already compact
+        conv.context = None
+        return
+
+    dropped = "\n\n".join(f"Question: {q}\nAnswer: {a}" for q, a in overflow)
+    previous = f"Existing summary:\n{conv.summary}\n\n" if conv.summary else ""
+    prompt = f"""{previous}Summarize the following conversation in a few sentences, keeping any facts the user may ask about again.
+
+{dropped}
+
+Summary:"""
+    try:
+        summary, _ = rag.generate_with_context(prompt)
+    except rag.OllamaError as e:
+        print(f"⚠️  Conversation {conv.id[:8]}: summary failed, keeping full history ({e})")
+        return
+
+    conv.summary = summary.strip()
+    conv.turns = conv.turns[-keep:]
+    conv.passages = conv.passages[-MAX_PASSAGES:]
+
+    # The cached context holds the full history, start from the compact prompt next turn
+    conv.context = None
+    print(f"📝 Conversation {conv.id[:8]}: summarized {len(overflow)} old turns")
+
+
+def ask(conv: Conversation, query: str, passages: list):
+    """Answer a question inside a conversation.
+
+    The first turn (or the first after history was compacted) sends the full
+    prompt. Follow-ups continue from the stored Ollama context and only send
+    the question plus any newly retrieved documents. At most MAX_PASSAGES
+    documents are kept; when a follow-up would exceed that, the oldest are
+    dropped and the prompt is rebuilt. Once the context grows past
+    CONTEXT_TOKEN_BUDGET, old turns are summarized and the next turn starts
+    from a fresh prompt.
+
+    Returns (answer, passages the answer was based on). Raises rag.OllamaError
+    if no answer was generated; the conversation is left unchanged then.
+    """
+    with conv.lock:
+        known = _apply_removals(conv, conv.passages)
+        retrieved = [p for p in passages if p.get('id') not in conv.removed_ids]
+        known_ids = {p.get('id') for p in known}
+        new_passages = [p for p in retrieved if p.get('id') not in known_ids]
+        merged = _merge_passages(known, retrieved)
+
+        context = conv.context
+        if context and len(merged) <= MAX_PASSAGES:
+            prompt = rag.build_followup_prompt(query, new_passages, start=len(known) + 1)
+            print(f"♻️  Conversation {conv.id[:8]}: reusing context ({len(context)} tokens)")
+        else:
+            merged = merged[-MAX_PASSAGES:]
+            prompt = rag.build_prompt(query, merged, _history_str(conv))
+            context = None
+
+        answer, new_context = rag.generate_with_context(prompt, context)
+
+        conv.passages = merged
+        conv.turns.append((query, answer))
+        conv.context = new_context
+        conv.last_used = time.monotonic()
+
+        # A document deleted while generating may be in the new context
+        conv.passages = _apply_removals(conv, conv.passages)
+        sources = list(conv.passages)
+
+        over_budget = conv.context is not None and len(conv.context) > CONTEXT_TOKEN_BUDGET
+        if len(conv.turns) > MAX_TURNS or over_budget:
+            _summarize_overflow(conv)
+        if over_budget:
+            # Even if the summary failed, never continue from an oversized context
+            conv.context = None
+
+        return answer, sources
@@ -1,18 +1,28 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Header
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
 from typing import List, Optional
 import models
 import database
 import auth
 import rag
+import conversations
+import scheduler
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 import uuid
+import os
+import anyio
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Requests waiting for the model block a worker thread each
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, scheduler.llm.threads_needed)
+    
     db = database.SessionLocal()
     try:
         # Existing admin logic
@@ -58,6 +68,39 @@ app.add_middleware(
 
 models.Base.metadata.create_all(bind=database.engine)
 
+@app.exception_handler(scheduler.Overloaded)
+def overloaded_handler(request, exc: scheduler.Overloaded):
+    print(f"🚦 Rejected {request.url.path}: {exc.reason} (retry after {exc.retry_after}s)")
+    return JSONResponse(
+        status_code=429,
+        content={"detail": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# Peers allowed to report the real client in X-Forwarded-For. The app is served
+# through the Express server (server/routes.ts), which proxies /api from
+# localhost and appends the browser's address. Set TRUSTED_PROXIES if the
+# backend sits behind a different proxy; requests from any other peer are
+# keyed on their own address and their X-Forwarded-For is ignored.
+TRUSTED_PROXIES = set(os.environ.get("TRUSTED_PROXIES", "127.0.0.1,::1").split(","))
+
+def client_address(http_request: Request) -> str:
+    peer = http_request.client.host if http_request.client else "unknown"
+    forwarded = http_request.headers.get("x-forwarded-for")
+    if peer in TRUSTED_PROXIES and forwarded:
+        # The last hop was added by our proxy; anything before it is client-supplied
+        return forwarded.split(",")[-1].strip()
+    return peer
+
+def rate_key(current_user: models.User, http_request: Request) -> str:
+    """Who a request is charged to by the scheduler.
+
+    Anyone can mint a new guest session, so guests are limited per client address.
+    """
+    if current_user.role == "guest":
+        return f"guest@{client_address(http_request)}"
+    return auth.principal_key(current_user)
+
 # ========== SCHEMAS ==========
 
 class UserCreate(BaseModel):
@@ -77,6 +120,15 @@ class QueryResponse(BaseModel):
     answer: str
     sources: List[dict]
 
+class ChatRequest(BaseModel):
+    query: str
+    conversation_id: Optional[str] = None
+
+class ChatResponse(BaseModel):
+    answer: str
+    sources: List[dict]
+    conversation_id: str
+
 # ========== AUTH ROUTES ==========
 
 @app.post("/api/auth/register")
@@ -162,6 +214,7 @@ def logout(current_user: models.User = Depends(auth.get_current_user), db: Sessi
                 pass
         
         db.commit()
+        conversations.drop_owner(auth.principal_key(current_user))
         print(f"🗑️  Deleted {deleted} guest documents for session {session_id}")
     
     return {"message": "Logged out successfully"}
@@ -202,6 +255,7 @@ def get_documents(current_user: models.User = Depends(auth.get_current_user), db
 
 @app.post("/api/upload")
 async def upload_document(
+    http_request: Request,
     file: UploadFile = File(...),
     current_user: models.User = Depends(auth.get_current_user),
     db: Session = Depends(database.get_db)
@@ -243,26 +297,33 @@ async def upload_document(
     session_id = getattr(current_user, 'session_id', None) if is_guest else None
     user_id = None if is_guest else current_user.id
     
-    # Save to database
-    new_doc = models.Document(
-        user_id=user_id,
-        session_id=session_id,
-        is_guest=is_guest,
-        title=file.filename,
-        filename=file.filename,
-        content=content,
-        file_type=file_extension
+    # Wait for a model slot before saving, so a rejected upload leaves nothing behind
+    acquired_at = await run_in_threadpool(
+        scheduler.llm.acquire, rate_key(current_user, http_request), current_user.role
     )
-    db.add(new_doc)
-    db.commit()
-    db.refresh(new_doc)
-    
-    # Add to RAG - CRITICAL: Add guest documents too!
     try:
-        rag.add_document_to_index(new_doc.id, content, is_guest=is_guest, session_id=session_id)
-        print(f"✅ Added to RAG: doc_id={new_doc.id}, guest={is_guest}")
-    except Exception as e:
-        print(f"⚠️  RAG error: {e}")
+        # Save to database
+        new_doc = models.Document(
+            user_id=user_id,
+            session_id=session_id,
+            is_guest=is_guest,
+            title=file.filename,
+            filename=file.filename,
+            content=content,
+            file_type=file_extension
+        )
+        db.add(new_doc)
+        db.commit()
+        db.refresh(new_doc)
+        
+        # Add to RAG - CRITICAL: Add guest documents too!
+        try:
+            await run_in_threadpool(rag.add_document_to_index, new_doc.id, content, is_guest=is_guest, session_id=session_id)
+            print(f"✅ Added to RAG: doc_id={new_doc.id}, guest={is_guest}")
+        except Exception as e:
+            print(f"⚠️  RAG error: {e}")
+    finally:
+        scheduler.llm.release(acquired_at)
     
     return {"id": new_doc.id, "filename": new_doc.filename}
 
@@ -299,20 +360,19 @@ def delete_document(
         rag.remove_document_from_index(doc_id)
     except Exception as e:
         print(f"⚠️  RAG removal error: {e}")
+    conversations.forget_document(doc_id)
     
     print(f"✅ Deleted doc_id={doc_id}")
     return {"message": "Document deleted", "id": doc_id}
 
 # ========== CHATBOT ROUTES ==========
 
-@app.post("/api/query", response_model=QueryResponse)
-def query_rag(
-    request: QueryRequest,
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(database.get_db)
-):
-    print(f"\n💬 QUERY: '{request.query}' by {current_user.username} (Role: {current_user.role})")
-    
+def retrieve_accessible(query: str, current_user: models.User, db: Session):
+    """Run RAG retrieval restricted to the documents the user may see.
+
+    Returns (results, fallback_answer); fallback_answer is set when there is
+    nothing to answer from.
+    """
     # Determine accessible documents
     if current_user.role == "admin":
         # ADMIN: All non-guest documents
@@ -323,10 +383,7 @@ def query_rag(
         # GUEST: Only their session documents
         session_id = getattr(current_user, 'session_id', None)
         if not session_id:
-            return {
-                "answer": "Please upload a document so I can help you.",
-                "sources": []
-            }
+            return [], "Please upload a document so I can help you."
         
         accessible_docs = db.query(models.Document).filter(
             models.Document.is_guest == True,
@@ -336,10 +393,7 @@ def query_rag(
         print(f"👤 Guest {session_id[:8]} can access {len(accessible_docs)} documents")
         
         if not accessible_docs:
-            return {
-                "answer": "Please upload a document so I can help you.",
-                "sources": []
-            }
+            return [], "Please upload a document so I can help you."
         
     else:
         # USER: Only their own documents
@@ -350,15 +404,12 @@ def query_rag(
         print(f"👤 User {current_user.username} can access {len(accessible_docs)} documents")
         
         if not accessible_docs:
-            return {
-                "answer": "You don't have any documents uploaded yet. Please upload a document first.",
-                "sources": []
-            }
+            return [], "You don't have any documents uploaded yet. Please upload a document first."
     
     accessible_doc_ids = [d.id for d in accessible_docs]
     
     # Query RAG
-    all_results = rag.query_index(request.query, k=10)
+    all_results = rag.query_index(query, k=10)
     print(f"🔍 RAG returned {len(all_results)} results")
     
     # Filter to accessible documents only
@@ -367,20 +418,67 @@ def query_rag(
     
     if not filtered_results:
         if current_user.role == "guest":
-            return {
-                "answer": "I couldn't find relevant information in your uploaded document. Try asking something else or upload a different document.",
-                "sources": []
-            }
-        return {
-            "answer": "I couldn't find any relevant information in your documents to answer this question.",
-            "sources": []
-        }
-    
-    # Generate answer
-    answer = rag.generate_answer(request.query, filtered_results)
+            return [], "I couldn't find relevant information in your uploaded document. Try asking something else or upload a different document."
+        return [], "I couldn't find any relevant information in your documents to answer this question."
+    
+    return filtered_results, None
+
+@app.post("/api/query", response_model=QueryResponse)
+def query_rag(
+    request: QueryRequest,
+    http_request: Request,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(database.get_db)
+):
+    print(f"\n💬 QUERY: '{request.query}' by {current_user.username} (Role: {current_user.role})")
+    
+    with scheduler.llm.slot(rate_key(current_user, http_request), current_user.role):
+        filtered_results, fallback = retrieve_accessible(request.query, current_user, db)
+        if fallback:
+            return {"answer": fallback, "sources": []}
+        
+        # Generate answer
+        answer = rag.generate_answer(request.query, filtered_results)
     
     return {"answer": answer, "sources": filtered_results}
 
+@app.post("/api/chat", response_model=ChatResponse)
+def chat(
+    request: ChatRequest,
+    http_request: Request,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(database.get_db)
+):
+    """Multi-turn chat: follow-ups continue from the stored model context"""
+    print(f"\n💬 CHAT: '{request.query}' by {current_user.username} (conversation={request.conversation_id})")
+    
+    # Only create the conversation once admitted, so rejected requests leave nothing behind
+    with scheduler.llm.slot(rate_key(current_user, http_request), current_user.role):
+        owner = auth.principal_key(current_user)
+        with conversations.checkout(request.conversation_id, owner) as conv:
+            if conv is None:
+                raise HTTPException(status_code=404, detail="Conversation not found or expired")
+            
+            filtered_results, fallback = retrieve_accessible(request.query, current_user, db)
+            if fallback and not conv.passages:
+                return {"answer": fallback, "sources": [], "conversation_id": conv.id}
+            
+            try:
+                answer, sources = conversations.ask(conv, request.query, filtered_results)
+            except rag.OllamaError as e:
+                if not request.conversation_id:
+                    # The client never learns this id, don't keep it around
+                    conversations.end(conv.id, owner)
+                raise HTTPException(status_code=502, detail=str(e))
+    
+    return {"answer": answer, "sources": sources, "conversation_id": conv.id}
+
+@app.delete("/api/chat/{conversation_id}")
+def end_chat(conversation_id: str, current_user: models.User = Depends(auth.get_current_user)):
+    if not conversations.end(conversation_id, auth.principal_key(current_user)):
+        raise HTTPException(status_code=404, detail="Conversation not found or expired")
+    return {"message": "Conversation ended", "conversation_id": conversation_id}
+
 @app.get("/api/users")
 def get_users(current_user: models.User = Depends(auth.get_current_user), db: Session = Depends(database.get_db)):
     if current_user.role != "admin":
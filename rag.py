@@ -5,6 +5,10 @@ import faiss
 
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
 MODEL_NAME = "llama3.1:8b"
+# Seconds to wait for Ollama, so a hung model cannot hold a scheduler slot forever
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", "120"))
+# Context window requested from Ollama; prompts are sized to fit in it
+NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", "8192"))
 
 index = None
 documents_map = {}  # faiss_idx -> {id, content, is_guest, session_id}
@@ -14,7 +18,7 @@ def get_embedding(text: str):
         resp = requests.post(f"{OLLAMA_HOST}/api/embeddings", json={
             "model": MODEL_NAME,
             "prompt": text
-        })
+        }, timeout=OLLAMA_TIMEOUT)
         data = resp.json()
         emb = data.get("embedding")
         if emb is None:
@@ -95,42 +99,81 @@ def remove_document_from_index(doc_id: int):
     # Note: We don't remove from the physical FAISS 'index' object 
     # because IndexFlatL2 doesn't support it well. 
     # Instead, our 'query_index' already filters results using documents_map.
-def generate_answer(query: str, context: list):
-    """Generate answer using Ollama"""
-    if not context:
-        return "I don't have any relevant documents to answer this question."
-    
-    context_str = "\n\n".join([
-        f"Document {i+1}:\n{item['content'][:1000]}"
-        for i, item in enumerate(context)
+
+class OllamaError(Exception):
+    """Ollama did not produce a response"""
+
+def format_documents(docs: list, start: int = 1):
+    """Render retrieved documents as numbered prompt sections"""
+    return "\n\n".join([
+        f"Document {i+start}:\n{item['content'][:1000]}"
+        for i, item in enumerate(docs)
     ])
-    
-    prompt = f"""Based on the following documents, please answer the question.
+
+def build_prompt(query: str, docs: list, history: str = ""):
+    """Full RAG prompt: documents, optional conversation so far, then the question"""
+    history_block = f"\n\nConversation so far:\n{history}" if history else ""
+    return f"""Based on the following documents, please answer the question.
 
 Documents:
-{context_str}
+{format_documents(docs)}{history_block}
 
 Question: {query}
 
 Answer (provide a helpful response based on the documents above):"""
 
+def build_followup_prompt(query: str, new_docs: list, start: int):
+    """Prompt continuing a conversation whose documents are already in the context"""
+    extra = ""
+    if new_docs:
+        extra = f"Additional documents:\n{format_documents(new_docs, start=start)}\n\n"
+    return f"""{extra}Question: {query}
+
+Answer (provide a helpful response based on the documents above):"""
+
+def generate_with_context(prompt: str, context_tokens: list = None):
+    """Call Ollama generate, optionally continuing from a previous `context`.
+
+    Returns (response_text, context). Passing the context returned by the
+    previous call lets Ollama skip re-processing everything it has already
+    seen, so only the new prompt tokens are evaluated. Raises OllamaError
+    when no response could be generated.
+    """
+    payload = {
+        "model": MODEL_NAME,
+        "prompt": prompt,
+        "stream": False,
+        "options": {"num_ctx": NUM_CTX}
+    }
+    if context_tokens:
+        payload["context"] = context_tokens
+
     try:
-        resp = requests.post(f"{OLLAMA_HOST}/api/generate", json={
-            "model": MODEL_NAME,
-            "prompt": prompt,
-            "stream": False
-        })
+        resp = requests.post(f"{OLLAMA_HOST}/api/generate", json=payload, timeout=OLLAMA_TIMEOUT)
         data = resp.json()
-        
-        response_text = data.get("response")
-        if response_text:
-            return response_text
-        
-        print(f"⚠️  Unexpected Ollama response: {data}")
-        return "No response from Ollama."
     except Exception as e:
         print(f"❌ Ollama error: {e}")
-        return f"Error generating answer: {e}"
+        raise OllamaError(f"Error generating answer: {e}") from e
+    
+    response_text = data.get("response")
+    if response_text:
+        return response_text, data.get("context")
+    
+    print(f"⚠️  Unexpected Ollama response: {data}")
+    raise OllamaError("No response from Ollama.")
+
+def generate_answer(query: str, context: list):
+    """Generate answer using Ollama"""
+    if not context:
+        return "I don't have any relevant documents to answer this question."
+    
+    prompt = build_prompt(query, context)
+
+    try:
+        answer, _ = generate_with_context(prompt)
+    except OllamaError as e:
+        return str(e)
+    return answer
     
 def sync_existing_documents(docs_from_db: list):
     """Rebuild the RAG index from database records on startup"""
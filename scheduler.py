@@ -0,0 +1,190 @@
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", "1"))
+MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", "16"))
+QUEUE_TIMEOUT_SECONDS = float(os.environ.get("LLM_QUEUE_TIMEOUT", "60"))
+
+# Lower number is served first
+ROLE_PRIORITY = {"admin": 0, "user": 1, "guest": 2}
+
+# role -> (requests, per seconds); None means unlimited
+RATE_LIMITS = {
+    "admin": None,
+    "user": (30, 60),
+    "guest": (10, 60),
+}
+MAX_TRACKED_PRINCIPALS = 10000
+
+# Waiters block a worker thread, so the threadpool must fit every slot and
+# queued request plus this many threads for unrelated endpoints
+THREADPOOL_HEADROOM = 16
+
+
+class Overloaded(Exception):
+    """Request rejected by admission control; retry after `retry_after` seconds"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class _Ticket:
+    def __init__(self, priority: int, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.shed = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _TokenBucket:
+    def __init__(self, capacity: int, per_seconds: float, now: float):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available, without consuming it"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def spend(self):
+        # May go negative when several queued requests are admitted; the debt
+        # simply delays the principal's next request
+        self.tokens -= 1
+
+
+class Scheduler:
+    """Bounded-concurrency gate in front of Ollama with a priority wait queue.
+
+    At most `max_concurrent` requests run at once and at most `max_queue` wait.
+    Waiters are served by role priority, then arrival order. When the queue is
+    full, a newcomer that outranks the worst waiter takes its place and the
+    waiter is rejected; otherwise the newcomer is rejected immediately.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT, max_queue: int = MAX_QUEUE,
+                 queue_timeout: float = QUEUE_TIMEOUT_SECONDS, rate_limits: dict = None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate_limits = RATE_LIMITS if rate_limits is None else rate_limits
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = []  # heap of _Ticket
+        self._seq = itertools.count()
+        self._buckets = {}  # principal -> _TokenBucket
+        self._avg_service = 5.0  # EWMA of slot hold time, seconds
+
+    def _estimated_wait(self, position: int) -> float:
+        return self._avg_service * (position // self.max_concurrent + 1)
+
+    def _check_rate(self, principal: str, role: str, now: float):
+        """Reject if the principal is over its rate; return its bucket to spend on admission"""
+        # Unknown roles are treated as guests, as in ROLE_PRIORITY
+        limit = self.rate_limits.get(role, self.rate_limits.get("guest"))
+        if limit is None:
+            return None
+        bucket = self._buckets.get(principal)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED_PRINCIPALS:
+                # Idle buckets are full again, dropping them changes nothing
+                self._buckets = {k: b for k, b in self._buckets.items()
+                                 if b.tokens + (now - b.updated) * b.rate < b.capacity}
+            bucket = self._buckets[principal] = _TokenBucket(limit[0], limit[1], now)
+        wait = bucket.wait_time(now)
+        if wait:
+            raise Overloaded("Rate limit exceeded", wait)
+        return bucket
+
+    def acquire(self, principal: str, role: str) -> float:
+        """Block until a slot is free; return the acquisition time for release().
+
+        The rate limit is only charged once the request gets a slot, so
+        requests rejected as busy or timed out do not use up the budget.
+        """
+        priority = ROLE_PRIORITY.get(role, ROLE_PRIORITY["guest"])
+
+        with self._cond:
+            now = time.monotonic()
+            bucket = self._check_rate(principal, role, now)
+
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                if bucket:
+                    bucket.spend()
+                return now
+
+            ticket = _Ticket(priority, next(self._seq))
+            if len(self._waiting) >= self.max_queue:
+                worst = max(self._waiting) if self._waiting else None
+                if worst is None or not ticket < worst:
+                    raise Overloaded("Server busy", self._estimated_wait(len(self._waiting)))
+                # Shed the lowest-priority waiter to make room
+                worst.shed = True
+                self._waiting.remove(worst)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+            heapq.heappush(self._waiting, ticket)
+            deadline = now + self.queue_timeout
+            try:
+                while True:
+                    if ticket.shed:
+                        raise Overloaded("Server busy", self._estimated_wait(len(self._waiting)))
+                    if self._waiting[0] is ticket and self._active < self.max_concurrent:
+                        heapq.heappop(self._waiting)
+                        self._active += 1
+                        if bucket:
+                            bucket.spend()
+                        # Another slot may still be free for the next waiter
+                        self._cond.notify_all()
+                        return time.monotonic()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                        self._cond.notify_all()
+                        raise Overloaded("Timed out waiting for the model", self._estimated_wait(len(self._waiting)))
+                    self._cond.wait(remaining)
+            except BaseException:
+                if not ticket.shed and ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                raise
+
+    def release(self, acquired_at: float):
+        with self._cond:
+            self._active -= 1
+            held = time.monotonic() - acquired_at
+            self._avg_service = 0.8 * self._avg_service + 0.2 * held
+            self._cond.notify_all()
+
+    @property
+    def threads_needed(self) -> int:
+        return self.max_concurrent + self.max_queue + THREADPOOL_HEADROOM
+
+    @contextmanager
+    def slot(self, principal: str, role: str):
+        acquired_at = self.acquire(principal, role)
+        try:
+            yield
+        finally:
+            self.release(acquired_at)
+
+
+llm = Scheduler()
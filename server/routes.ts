@@ -26,6 +26,7 @@ export async function registerRoutes(
   app.use("/api/upload", createProxyMiddleware({
     target: "http://127.0.0.1:8000",
     changeOrigin: true,
+    xfwd: true, // Backend rate-limits guests by X-Forwarded-For
     pathRewrite: () => "/api/upload", // Ensure path is preserved
   }));
   
@@ -42,6 +43,11 @@ export async function registerRoutes(
       if (req.headers['authorization']) {
         headers['Authorization'] = req.headers['authorization'] as string;
       }
+      // Backend rate-limits guests by client address and trusts this header from localhost
+      const forwardedFor = [req.headers['x-forwarded-for'], req.socket.remoteAddress].flat().filter(Boolean);
+      if (forwardedFor.length > 0) {
+        headers['X-Forwarded-For'] = forwardedFor.join(', ');
+      }
 
       const options: RequestInit = {
         method: req.method,
@@ -58,6 +64,12 @@ export async function registerRoutes(
       
       res.status(response.status);
       
+      // Let clients back off when the backend rejects with 429
+      const retryAfter = response.headers.get('retry-after');
+      if (retryAfter) {
+        res.set('Retry-After', retryAfter);
+      }
+      
       if (contentType?.includes('application/json')) {
         const data = await response.json();
         res.json(data);
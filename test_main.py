@@ -1,5 +1,11 @@
+import threading
+import time
 import pytest
 from fastapi.testclient import TestClient
+import main
+import conversations
+import rag
+import scheduler
 from main import app
 
 client = TestClient(app)
@@ -23,4 +29,358 @@ def test_guest_login():
     """Test guest login"""
     response = client.post("/api/auth/guest")
     assert response.status_code == 200
-    assert "access_token" in response.json()
\ No newline at end of file
+    assert "access_token" in response.json()
+
+def test_chat_unknown_conversation():
+    """Test that an unknown conversation id is rejected"""
+    token = client.post("/api/auth/guest").json()["access_token"]
+    response = client.post("/api/chat", json={
+        "query": "hello",
+        "conversation_id": "does-not-exist"
+    }, headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 404
+
+def _fake_ollama(monkeypatch, fail_on=None):
+    """Replace Ollama with a stub that records prompts and can fail on demand"""
+    calls = []
+    def fake_generate(prompt, context_tokens=None):
+        calls.append((prompt, context_tokens))
+        if fail_on and fail_on(prompt):
+            raise rag.OllamaError("Error generating answer: boom")
+        return f"answer {len(calls)}", [len(calls)]
+    monkeypatch.setattr(rag, "generate_with_context", fake_generate)
+    return calls
+
+def test_chat_followup_reuses_context(monkeypatch):
+    """Test that follow-up turns only send the new question with the stored context"""
+    calls = _fake_ollama(monkeypatch)
+
+    conv = conversations.get_or_create(None, "user:test")
+    passage = {"id": 1, "content": "The sky is blue."}
+    conversations.ask(conv, "What colour is the sky?", [passage])
+    conversations.ask(conv, "Are you sure?", [passage])
+
+    assert "The sky is blue." in calls[0][0] and calls[0][1] is None
+    assert "The sky is blue." not in calls[1][0] and calls[1][1] == [1]
+    assert conversations.end(conv.id, "user:test")
+
+def test_chat_summarizes_overflow(monkeypatch):
+    """Test that old turns are folded into a summary and the prompt is rebuilt"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    calls = _fake_ollama(monkeypatch)
+    conv = conversations.get_or_create(None, "user:test")
+    for i in range(conversations.MAX_TURNS + 1):
+        conversations.ask(conv, f"question {i}", [{"id": i, "content": f"doc {i}"}])
+
+    assert "Summarize" in calls[-1][0]
+    assert len(conv.turns) == conversations.MAX_TURNS // 2
+    assert conv.summary and conv.context is None
+
+    conversations.ask(conv, "next", [])
+    assert calls[-1][1] is None and conv.summary in calls[-1][0]
+
+def test_chat_failed_summary_keeps_history(monkeypatch):
+    """Test that a failed summary call does not lose turns or the old summary"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    _fake_ollama(monkeypatch, fail_on=lambda prompt: "Summarize" in prompt)
+    conv = conversations.get_or_create(None, "user:test")
+    conv.summary = "earlier facts"
+    for i in range(conversations.MAX_TURNS + 1):
+        conversations.ask(conv, f"question {i}", [])
+
+    assert conv.summary == "earlier facts"
+    assert len(conv.turns) == conversations.MAX_TURNS + 1
+
+def test_chat_failed_answer_leaves_conversation_unchanged(monkeypatch):
+    """Test that an Ollama failure is raised instead of stored as an answer"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    _fake_ollama(monkeypatch, fail_on=lambda prompt: "fails" in prompt)
+    conv = conversations.get_or_create(None, "user:test")
+    conversations.ask(conv, "works", [{"id": 1, "content": "doc"}])
+    context = conv.context
+
+    with pytest.raises(rag.OllamaError):
+        conversations.ask(conv, "fails", [{"id": 2, "content": "other"}])
+    assert conv.turns == [("works", "answer 1")]
+    assert [p["id"] for p in conv.passages] == [1]
+    assert conv.context == context
+
+def test_chat_passages_are_capped(monkeypatch):
+    """Test that only the most recently retrieved documents are kept"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    monkeypatch.setattr(conversations, "MAX_PASSAGES", 3)
+    calls = _fake_ollama(monkeypatch)
+    conv = conversations.get_or_create(None, "user:test")
+    for i in range(5):
+        conversations.ask(conv, f"question {i}", [{"id": i, "content": f"doc {i}"}])
+
+    assert [p["id"] for p in conv.passages] == [2, 3, 4]
+    assert calls[-1][1] is None and "doc 0" not in calls[-1][0]
+
+def test_chat_idle_and_lru_eviction(monkeypatch):
+    """Test TTL eviction, and that only creating a conversation evicts by LRU"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    monkeypatch.setattr(conversations, "MAX_SESSIONS", 2)
+    first = conversations.get_or_create(None, "user:1")
+    second = conversations.get_or_create(None, "user:2")
+
+    # Lookups at the cap do not evict anyone
+    assert conversations.get_or_create(first.id, "user:1") is first
+    assert conversations.get_or_create(second.id, "user:2") is second
+
+    # Creating one more evicts the least recently used
+    conversations.get_or_create(None, "user:3")
+    assert conversations.get_or_create(first.id, "user:1") is None
+
+    second.last_used -= conversations.SESSION_TTL_SECONDS + 1
+    assert conversations.get_or_create(second.id, "user:2") is None
+
+def test_chat_forget_document_clears_context(monkeypatch):
+    """Test that deleting a document drops it and the context that contains it"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    calls = _fake_ollama(monkeypatch)
+    conv = conversations.get_or_create(None, "user:test")
+    conversations.ask(conv, "first", [{"id": 1, "content": "secret"}, {"id": 2, "content": "kept"}])
+
+    conversations.forget_document(1)
+    conversations.ask(conv, "second", [])
+    assert calls[-1][1] is None and "secret" not in calls[-1][0]
+    assert [p["id"] for p in conv.passages] == [2]
+
+    # Deleted while the answer is being generated
+    def delete_mid_generation(prompt, context_tokens=None):
+        conversations.forget_document(2)
+        return "answer", [99]
+    monkeypatch.setattr(rag, "generate_with_context", delete_mid_generation)
+    conversations.ask(conv, "third", [])
+    assert conv.context is None and conv.passages == []
+
+def test_chat_context_over_budget_is_not_reused(monkeypatch):
+    """Test that an oversized Ollama context is dropped and old turns summarized"""
+    calls = []
+    def fake_generate(prompt, context_tokens=None):
+        calls.append((prompt, context_tokens))
+        return "answer", [0] * (conversations.CONTEXT_TOKEN_BUDGET + 1)
+    monkeypatch.setattr(rag, "generate_with_context", fake_generate)
+    monkeypatch.setattr(conversations, "_sessions", {})
+    conv = conversations.get_or_create(None, "user:test")
+
+    conversations.ask(conv, "first", [{"id": 1, "content": "doc"}])
+    assert conv.context is None
+    conversations.ask(conv, "second", [])
+    assert calls[-1][1] is None and "first" in calls[-1][0]
+
+    for i in range(conversations.MAX_TURNS // 2):
+        conversations.ask(conv, f"more {i}", [])
+    assert "Summarize" in calls[-1][0]
+    assert len(conv.turns) == conversations.MAX_TURNS // 2 and conv.context is None
+
+def test_chat_per_owner_cap(monkeypatch):
+    """Test that one principal's new conversations only evict its own oldest one"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    monkeypatch.setattr(conversations, "MAX_SESSIONS_PER_OWNER", 2)
+    other = conversations.get_or_create(None, "user:other")
+    mine = [conversations.get_or_create(None, "user:spam") for _ in range(5)]
+
+    assert conversations.get_or_create(other.id, "user:other") is other
+    alive = [c for c in mine if conversations.get_or_create(c.id, "user:spam")]
+    assert alive == mine[-2:]
+
+def test_chat_checked_out_conversation_is_not_evicted(monkeypatch):
+    """Test that a conversation in use survives eviction and stays reachable"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    monkeypatch.setattr(conversations, "MAX_SESSIONS_PER_OWNER", 1)
+    with conversations.checkout(None, "user:1") as busy:
+        conversations.get_or_create(None, "user:1")
+        assert conversations.get_or_create(busy.id, "user:1") is busy
+    assert busy.in_use == 0
+
+def test_chat_sources_match_stored_passages(monkeypatch):
+    """Test that a follow-up answered from stored passages reports them as sources"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    monkeypatch.setattr(scheduler, "llm", scheduler.Scheduler())
+    _fake_ollama(monkeypatch)
+    passage = {"id": 1, "content": "doc"}
+    results = [([passage], None), ([], "I couldn't find any relevant information")]
+    monkeypatch.setattr(main, "retrieve_accessible", lambda query, user, db: results.pop(0))
+    token = client.post("/api/auth/guest").json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    first = client.post("/api/chat", json={"query": "hello"}, headers=headers).json()
+    second = client.post("/api/chat", json={
+        "query": "and?",
+        "conversation_id": first["conversation_id"]
+    }, headers=headers).json()
+    assert second["sources"] == [passage]
+
+def test_scheduler_rejects_when_queue_full():
+    """Test that a full wait queue fails fast with a retry hint"""
+    sched = scheduler.Scheduler(max_concurrent=1, max_queue=0, rate_limits={})
+    acquired_at = sched.acquire("user:1", "user")
+    with pytest.raises(scheduler.Overloaded) as exc:
+        sched.acquire("user:2", "user")
+    assert exc.value.retry_after >= 1
+    sched.release(acquired_at)
+
+def _wait_for_queue(sched, length):
+    """Block until `length` requests are waiting in the scheduler"""
+    deadline = time.monotonic() + 5
+    while len(sched._waiting) != length:
+        assert time.monotonic() < deadline, "scheduler queue never reached expected length"
+        time.sleep(0.001)
+
+def _queue_in_thread(sched, principal, role, order):
+    def worker():
+        try:
+            with sched.slot(principal, role):
+                order.append(role)
+        except scheduler.Overloaded as e:
+            order.append(f"{role} rejected: {e.reason}")
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    return thread
+
+def test_scheduler_serves_admin_first():
+    """Test that queued admins are admitted before earlier guests"""
+    sched = scheduler.Scheduler(max_concurrent=1, max_queue=4, rate_limits={})
+    held = sched.acquire("user:1", "user")
+    order = []
+
+    guest = _queue_in_thread(sched, "guest@a", "guest", order)
+    _wait_for_queue(sched, 1)
+    admin = _queue_in_thread(sched, "user:2", "admin", order)
+    _wait_for_queue(sched, 2)
+
+    sched.release(held)
+    guest.join()
+    admin.join()
+    assert order == ["admin", "guest"]
+
+def test_scheduler_sheds_lower_priority_waiter():
+    """Test that a full queue makes room for an admin by rejecting a guest"""
+    sched = scheduler.Scheduler(max_concurrent=1, max_queue=1, rate_limits={})
+    held = sched.acquire("user:1", "user")
+    order = []
+
+    guest = _queue_in_thread(sched, "guest@a", "guest", order)
+    _wait_for_queue(sched, 1)
+    admin = _queue_in_thread(sched, "user:2", "admin", order)
+    guest.join()
+    assert order == ["guest rejected: Server busy"]
+
+    # An equal-priority newcomer is rejected instead of shedding
+    with pytest.raises(scheduler.Overloaded):
+        sched.acquire("user:3", "admin")
+
+    sched.release(held)
+    admin.join()
+    assert order[-1] == "admin"
+
+def test_scheduler_queue_timeout():
+    """Test that a waiter gives up after the queue timeout and leaves the queue"""
+    sched = scheduler.Scheduler(max_concurrent=1, max_queue=1, queue_timeout=0.01, rate_limits={})
+    held = sched.acquire("user:1", "user")
+    with pytest.raises(scheduler.Overloaded) as exc:
+        sched.acquire("user:2", "user")
+    assert exc.value.reason == "Timed out waiting for the model"
+    assert sched._waiting == []
+    sched.release(held)
+
+def test_scheduler_busy_does_not_spend_rate():
+    """Test that requests rejected as busy are not charged to the rate limit"""
+    sched = scheduler.Scheduler(max_concurrent=1, max_queue=0, rate_limits={"user": (1, 60)})
+    held = sched.acquire("user:1", "user")
+    for _ in range(3):
+        with pytest.raises(scheduler.Overloaded) as exc:
+            sched.acquire("user:2", "user")
+        assert exc.value.reason == "Server busy"
+    sched.release(held)
+
+    sched.release(sched.acquire("user:2", "user"))
+    with pytest.raises(scheduler.Overloaded) as exc:
+        sched.acquire("user:2", "user")
+    assert exc.value.reason == "Rate limit exceeded"
+
+def test_rate_limit_returns_429(monkeypatch):
+    """Test that exceeding the per-principal rate limit returns 429 with Retry-After"""
+    monkeypatch.setattr(scheduler, "llm", scheduler.Scheduler(rate_limits={"guest": (1, 60)}))
+    token = client.post("/api/auth/guest").json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/api/query", json={"query": "hello"}, headers=headers)
+    response = client.post("/api/query", json={"query": "hello"}, headers=headers)
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+
+def test_rate_limit_covers_new_guest_sessions(monkeypatch):
+    """Test that minting fresh guest tokens does not bypass the rate limit"""
+    monkeypatch.setattr(scheduler, "llm", scheduler.Scheduler(rate_limits={"guest": (1, 60)}))
+    statuses = []
+    for _ in range(3):
+        token = client.post("/api/auth/guest").json()["access_token"]
+        response = client.post("/api/query", json={"query": "hello"},
+                               headers={"Authorization": f"Bearer {token}"})
+        statuses.append(response.status_code)
+    assert statuses == [200, 429, 429]
+
+def test_rejected_chat_creates_no_conversation(monkeypatch):
+    """Test that chat requests turned away by the scheduler leave no session behind"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    busy = scheduler.Scheduler(max_concurrent=1, max_queue=0)
+    held = busy.acquire("user:1", "admin")
+    monkeypatch.setattr(scheduler, "llm", busy)
+    token = client.post("/api/auth/guest").json()["access_token"]
+    for _ in range(3):
+        response = client.post("/api/chat", json={"query": "hello"},
+                               headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 429
+    assert conversations._sessions == {}
+    busy.release(held)
+
+def test_failed_chat_creates_no_conversation(monkeypatch):
+    """Test that a new conversation is dropped when its first answer fails"""
+    monkeypatch.setattr(conversations, "_sessions", {})
+    monkeypatch.setattr(scheduler, "llm", scheduler.Scheduler())
+    monkeypatch.setattr(main, "retrieve_accessible", lambda query, user, db: ([{"id": 1, "content": "doc"}], None))
+    _fake_ollama(monkeypatch, fail_on=lambda prompt: True)
+    token = client.post("/api/auth/guest").json()["access_token"]
+    response = client.post("/api/chat", json={"query": "hello"},
+                           headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 502
+    assert conversations._sessions == {}
+
+def test_scheduler_unknown_role_is_limited_like_guest():
+    """Test that an unexpected role does not get admin-level rate treatment"""
+    sched = scheduler.Scheduler(rate_limits={"admin": None, "guest": (1, 60)})
+    sched.release(sched.acquire("user:1", "intern"))
+    with pytest.raises(scheduler.Overloaded):
+        sched.acquire("user:1", "intern")
+
+def test_rate_limit_uses_trusted_forwarded_address(monkeypatch):
+    """Test that guests behind our proxy are limited per real client address"""
+    monkeypatch.setattr(scheduler, "llm", scheduler.Scheduler(rate_limits={"guest": (1, 60)}))
+    monkeypatch.setattr(main, "TRUSTED_PROXIES", {"testclient"})
+
+    def query_from(forwarded_for):
+        token = client.post("/api/auth/guest").json()["access_token"]
+        return client.post("/api/query", json={"query": "hello"}, headers={
+            "Authorization": f"Bearer {token}",
+            "X-Forwarded-For": forwarded_for
+        }).status_code
+
+    assert query_from("10.0.0.1") == 200
+    assert query_from("10.0.0.2") == 200
+    # A client-supplied prefix does not change the address our proxy saw
+    assert query_from("1.2.3.4, 10.0.0.1") == 429
+
+def test_rate_limit_ignores_untrusted_forwarded_header(monkeypatch):
+    """Test that X-Forwarded-For from an untrusted peer cannot mint new budgets"""
+    monkeypatch.setattr(scheduler, "llm", scheduler.Scheduler(rate_limits={"guest": (1, 60)}))
+    statuses = []
+    for i in range(2):
+        token = client.post("/api/auth/guest").json()["access_token"]
+        statuses.append(client.post("/api/query", json={"query": "hello"}, headers={
+            "Authorization": f"Bearer {token}",
+            "X-Forwarded-For": f"10.0.0.{i}"
+        }).status_code)
+    assert statuses == [200, 429]